@@ -1,10 +1,18 @@
+import asyncio
 import logging
 import datetime
-import psycopg2
+import functools
+import time
+import asyncpg
 import voluptuous as vol
-from decimal import Decimal, ROUND_HALF_UP
-from homeassistant.const import EVENT_STATE_CHANGED, EVENT_HOMEASSISTANT_STARTED, CONF_HOST, CONF_PORT, CONF_USERNAME, CONF_PASSWORD, CONF_NAME
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from fractions import Fraction
+from homeassistant.const import EVENT_HOMEASSISTANT_STARTED, EVENT_HOMEASSISTANT_STOP, CONF_HOST, CONF_PORT, CONF_USERNAME, CONF_PASSWORD, CONF_NAME
+from homeassistant.components import websocket_api
+from homeassistant.core import callback
 from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers.event import async_track_state_change_event
 
 DOMAIN = "expenses_api"
 _LOGGER = logging.getLogger(__name__)
@@ -24,7 +32,188 @@ CONFIG_SCHEMA = vol.Schema(
     extra=vol.ALLOW_EXTRA,
 )
 
-def setup(hass, config):
+# Connection pool bounds; each DB call borrows a connection for its duration
+_POOL_MIN_CONN = 2
+_POOL_MAX_CONN = 10
+
+# Errors raised by asyncpg for server-side failures and lost/unreachable connections
+_DB_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError)
+
+# Dashboard helpers that drive the latest-expenses filters
+_FILTER_ENTITIES = frozenset({
+    "input_select.filter_paid_by",
+    "input_select.filter_category",
+    "input_datetime.filter_start_date",
+    "input_datetime.filter_end_date",
+})
+
+# Dashboard helpers making up the add-expense form
+_EXPENSE_FORM_ENTITIES = (
+    "input_datetime.expense_date",
+    "input_text.expense_description",
+    "input_select.expense_category",
+    "input_number.expense_amount",
+    "input_select.expense_paid_by",
+)
+
+# Helpers holding the expense split percentages
+_SPLIT_ENTITIES = frozenset({
+    "input_number.split_andre",
+    "input_number.split_helena",
+})
+
+# Quiet period used to coalesce bursts of filter changes into one query
+_REFRESH_DEBOUNCE_SECONDS = 0.15
+
+# Minimum gap between error notifications, so error cascades cannot flood the bus
+_NOTIFY_MIN_INTERVAL_SECONDS = 5
+
+# Idempotent data fixes applied once at startup, before the schema migrations
+_SCHEMA_BACKFILLS = (
+    # paid_by is stored normalized (trimmed, lowercase) so it can be compared
+    # directly against a plain index; backfill rows written before that
+    "UPDATE expenses SET paid_by = LOWER(TRIM(paid_by)) WHERE paid_by <> LOWER(TRIM(paid_by))",
+)
+
+# Idempotent schema tweaks applied once at startup
+_SCHEMA_MIGRATIONS = (
+    # Matches the ORDER BY of the latest-expenses query so it becomes an index walk
+    "CREATE INDEX IF NOT EXISTS expenses_date_id_desc ON expenses (date DESC, id DESC)",
+    # Per-payer partial indexes in list order; the prepared statements inline
+    # the payer as a literal so generic plans can match these predicates.
+    # Together with expenses_covering they supersede the plain paid_by index
+    "CREATE INDEX IF NOT EXISTS expenses_andre_date_id ON expenses (date DESC, id DESC) WHERE paid_by = 'andre'",
+    "CREATE INDEX IF NOT EXISTS expenses_helena_date_id ON expenses (date DESC, id DESC) WHERE paid_by = 'helena'",
+    "DROP INDEX IF EXISTS expenses_paid_by",
+    # Category filter walks its rows already in list order; supersedes the plain category index
+    "CREATE INDEX IF NOT EXISTS expenses_category_date_id ON expenses (category, date DESC, id DESC)",
+    "DROP INDEX IF EXISTS expenses_category",
+    # Covers the filtered list query (Postgres 11+) so it can run as an index-only scan
+    "CREATE INDEX IF NOT EXISTS expenses_covering ON expenses (date DESC, paid_by, category)"
+    " INCLUDE (id, description, cost)",
+    # Single-row running ledger totals, updated by the same statement as each insert
+    "CREATE TABLE IF NOT EXISTS balances ("
+    " id int PRIMARY KEY DEFAULT 1 CHECK (id = 1),"
+    " andre numeric NOT NULL DEFAULT 0,"
+    " helena numeric NOT NULL DEFAULT 0)",
+    # Totals are rebuilt from the expenses on every HA start; this only makes sure the row exists
+    "INSERT INTO balances (id) VALUES (1) ON CONFLICT (id) DO NOTHING",
+)
+
+# Sentinels keep the date range always bound, so each filter combination
+# maps to a single (asyncpg-cached) prepared statement with a stable plan
+_DATE_FLOOR = datetime.date(1970, 1, 1)
+_DATE_CEILING = datetime.date(9999, 12, 31)
+
+# Rows per latest-expenses page; later pages use a (date, id) keyset, never OFFSET
+_LATEST_PAGE_SIZE = 20
+
+# Keyset bound for the first page: every (date, id) row sorts below it
+_FIRST_PAGE_KEYSET = (_DATE_CEILING, 0)
+
+
+# One latest-expenses list entry; converted to a dict only when sent to clients
+Expense = namedtuple("Expense", "id date description category cost paid_by")
+
+# Money is read as integer cents (no Decimal per value) and written back as
+# cents * 0.01, which keeps NUMERIC columns at two decimal places
+_LATEST_SELECT = "id, date, description, category, (cost * 100)::bigint AS cost_cents, paid_by"
+
+# Payers known to the ledger. Their filter is inlined as a literal in the
+# statements so the planner can match partial indexes on paid_by
+_PAYERS = ("andre", "helena")
+
+# Statement key for a payer filter outside _PAYERS, bound as a parameter instead
+_OTHER_PAYER = "*"
+
+
+def _build_latest_statements():
+    """Return {(payer, by_category): sql} for the latest-expenses query.
+
+    payer is None (no filter), one of _PAYERS, or _OTHER_PAYER.
+    """
+    statements = {}
+    for payer in (None, *_PAYERS, _OTHER_PAYER):
+        for by_category in (False, True):
+            # Explicit parameter types so generic plans compare like-typed values against the indexes
+            query = (
+                f"SELECT {_LATEST_SELECT} FROM expenses"
+                " WHERE date >= $1::date AND date < $2::date AND (date, id) < ($3::date, $4::bigint)"
+            )
+            n = 4
+            if payer == _OTHER_PAYER:
+                n += 1
+                query += f" AND paid_by = ${n}::text"
+            elif payer is not None:
+                query += f" AND paid_by = '{payer}'"
+            if by_category:
+                n += 1
+                query += f" AND category = ${n}::text"
+            query += f" ORDER BY date DESC, id DESC LIMIT {_LATEST_PAGE_SIZE}"
+            statements[(payer, by_category)] = query
+    return statements
+
+
+_LATEST_STATEMENTS = _build_latest_statements()
+
+# Inserts a batch of expenses (one array per column) and bumps the balances
+# row by their sum, all in a single statement/round trip
+_INSERT_EXPENSES_SQL = (
+    "WITH ins AS ("
+    " INSERT INTO expenses (description, cost, category, date, andre, helena, paid_by)"
+    " SELECT description, cost_cents * 0.01, category, date, andre_cents * 0.01, helena_cents * 0.01, paid_by"
+    " FROM unnest($1::text[], $2::bigint[], $3::text[], $4::date[], $5::bigint[], $6::bigint[], $7::text[])"
+    " AS new (description, cost_cents, category, date, andre_cents, helena_cents, paid_by)"
+    " RETURNING id, date, description, category, cost, paid_by, andre, helena"
+    "), bal AS ("
+    " UPDATE balances SET andre = balances.andre + delta.andre, helena = balances.helena + delta.helena"
+    " FROM (SELECT COALESCE(SUM(andre), 0) AS andre, COALESCE(SUM(helena), 0) AS helena FROM ins) AS delta"
+    " WHERE balances.id = 1"
+    " RETURNING balances.andre, balances.helena"
+    ")"
+    " SELECT ins.id, ins.date, ins.description, ins.category, (ins.cost * 100)::bigint AS cost_cents, ins.paid_by,"
+    " (bal.andre * 100)::bigint AS andre_total_cents, (bal.helena * 100)::bigint AS helena_total_cents"
+    " FROM ins LEFT JOIN bal ON true"
+    " ORDER BY ins.id"
+)
+
+
+async def _insert_expenses(pool, rows):
+    """Insert rows of (description, cost_cents, category, date, andre_cents, helena_cents, paid_by).
+
+    Returns the inserted rows in id order; each carries the updated balances
+    totals (None if the balances row is missing).
+    """
+    if not rows:
+        return []
+    return await pool.fetch(_INSERT_EXPENSES_SQL, *map(list, zip(*rows)))
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_date(value):
+    """Parse the date part of an input_datetime state ("YYYY-MM-DD[ HH:MM:SS]")."""
+    return datetime.date.fromisoformat(value[:10])
+
+
+# --- Money helpers: amounts are handled as integer cents between I/O boundaries ---
+def _to_cents(value):
+    """Parse a money amount (number or numeric string) into integer cents, rounding half up."""
+    try:
+        return int((Decimal(str(value)) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+    except InvalidOperation as e:
+        raise ValueError(f"Invalid amount: {value!r}") from e
+
+
+def _div_round_half_up(numerator, denominator):
+    """Integer division rounding half away from zero (matches ROUND_HALF_UP)."""
+    q, r = divmod(abs(numerator), denominator)
+    if 2 * r >= denominator:
+        q += 1
+    return q if numerator >= 0 else -q
+
+
+async def async_setup(hass, config):
+    """Set up the Expenses API integration."""
 
     conf = config.get(DOMAIN, {})
 
@@ -34,124 +223,297 @@ def setup(hass, config):
     DB_NAME = conf.get("db_name")
     DB_USER = conf.get("db_user")
     DB_PASS = conf.get("db_pass")
-    # Debug output
-    print(f"[Expenses API] DB_HOST={DB_HOST}, DB_PORT={DB_PORT}, DB_NAME={DB_NAME}, DB_USER={DB_USER}, DB_PASS={'set' if DB_PASS else 'None'}")
-    """Set up the Expenses API integration."""
+    _LOGGER.debug("DB config host=%s port=%s name=%s user=%s", DB_HOST, DB_PORT, DB_NAME, DB_USER)
 
-    _LOGGER.info("🚀 expenses_api loaded")
+    _LOGGER.info("expenses_api loaded")
 
-    # Connect to the database
+    # Connect to the database; asyncpg prepares and caches statements per pooled connection
     try:
-        conn = psycopg2.connect(
+        pool = await asyncpg.create_pool(
             host=DB_HOST,
             port=DB_PORT,
             database=DB_NAME,
             user=DB_USER,
-            password=DB_PASS
+            password=DB_PASS,
+            min_size=_POOL_MIN_CONN,
+            max_size=_POOL_MAX_CONN,
         )
-        conn.autocommit = True
     except Exception as e:
         _LOGGER.error("Failed to connect to DB: %s", e)
         return False
-    
+
+    async def close_pool(event):
+        await pool.close()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, close_pool)
+
+    # --- Schema migrations ---
+    try:
+        async with pool.acquire() as conn:
+            backfilled = 0
+            for statement in _SCHEMA_BACKFILLS:
+                # Command status looks like "UPDATE 3"
+                status = await conn.execute(statement)
+                backfilled += int(status.rsplit(" ", 1)[-1])
+
+            # Each statement commits on its own, so one failing (e.g. INCLUDE on an old server) doesn't block the rest
+            for statement in _SCHEMA_MIGRATIONS:
+                try:
+                    await conn.execute(statement)
+                except asyncpg.PostgresError as e:
+                    _LOGGER.warning("Failed to apply schema migration %r: %s", statement, e)
+
+            if backfilled:
+                # Refresh the visibility map so index-only scans skip heap fetches
+                await conn.execute("VACUUM ANALYZE expenses")
+    except Exception as e:
+        _LOGGER.warning("Failed to apply schema migrations: %s", e)
+
     # --- Helper to safely get states ---
-    def safe_state(entity_id, default=None):
-        s = hass.states.get(entity_id)
-        return s.state if s and s.state not in (None, "unknown", "") else default
+    def snapshot_states(entity_ids):
+        """Return {entity_id: state} in one pass; missing, unknown or empty states map to None."""
+        states = {}
+        for entity_id in entity_ids:
+            s = hass.states.get(entity_id)
+            states[entity_id] = s.state if s and s.state not in (None, "unknown", "") else None
+        return states
 
     # --- Update latest expenses ---
-    def update_latest_expenses(event_time=None):
+    # Last published list and the (start, end_exclusive, paid_by, category) filters
+    # it was queried with, so a new expense can be merged in without re-querying.
+    # Only touched from the event loop, but a refresh awaits its query, so
+    # add_expense bumps "generation" to tell it that its rows may be stale, and
+    # each refresh takes a new "refresh_seq" so only the newest one publishes.
+    latest = {
+        "filters": None,
+        "expenses": [],
+        "digest": None,
+        "revision": 0,
+        "generation": 0,
+        "refresh_seq": 0,
+    }
+
+    def latest_expense_item(record):
+        """Return the Expense for a list row (asyncpg Record or mapping)."""
+        cost_cents = record["cost_cents"]
+        return Expense(
+            record["id"],
+            record["date"].isoformat() if record["date"] else None,
+            record["description"],
+            record["category"],
+            cost_cents / 100 if cost_cents is not None else 0.0,
+            record["paid_by"],
+        )
+
+    @callback
+    def publish_latest_expenses(expenses_list):
+        """Publish the list summary unless the rows are unchanged."""
+        digest = hash(tuple(expenses_list))
+        if digest == latest["digest"]:
+            return
+        latest["digest"] = digest
+        # Bumped on every content change so websocket clients know when to refetch
+        latest["revision"] += 1
+
+        # Keep the state small; the rows themselves are served by the expenses_api/list websocket command
+        hass.states.async_set(
+            "expenses_api.latest_expenses",
+            len(expenses_list),  # short state
+            attributes={
+                "count": len(expenses_list),
+                "last_id": max((e.id for e in expenses_list), default=None),
+                "revision": latest["revision"],
+            }
+        )
+
+    def page_cursor(expenses_list):
+        """Return the keyset for the page after expenses_list, or None if it was the last page."""
+        if len(expenses_list) < _LATEST_PAGE_SIZE:
+            return None
+        last = expenses_list[-1]
+        return {"before_date": last.date, "before_id": last.id}
+
+    @callback
+    def read_latest_filters():
+        """Return the active (start, end_exclusive, paid_by, category) filters from the dashboard helpers."""
+        states = snapshot_states(_FILTER_ENTITIES)
+        paid_by = states["input_select.filter_paid_by"] or "All"
+        category = states["input_select.filter_category"] or "All"
+        start_date_str = states["input_datetime.filter_start_date"]
+        end_date_str = states["input_datetime.filter_end_date"]
+
+        start_date = _parse_date(start_date_str) if start_date_str else None
+        end_date = _parse_date(end_date_str) if end_date_str else None
+
+        # Half-open range [start, end + 1 day) lines up with btree range scans;
+        # paid_by is stored normalized, so compare the bare column (index friendly)
+        return (
+            start_date or _DATE_FLOOR,
+            end_date + datetime.timedelta(days=1) if end_date else _DATE_CEILING,
+            paid_by.strip().lower() if paid_by != "All" else None,
+            category if category != "All" else None,
+        )
+
+    async def fetch_latest_page(filters, keyset=_FIRST_PAGE_KEYSET):
+        """Return one page of list entries matching filters, strictly below the (date, id) keyset."""
+        start_date, end_exclusive, paid_by, category = filters
+        params = [start_date, end_exclusive, keyset[0], keyset[1]]
+        payer_key = paid_by
+        if paid_by is not None and paid_by not in _PAYERS:
+            payer_key = _OTHER_PAYER
+            params.append(paid_by)
+        if category is not None:
+            params.append(category)
+
+        rows = await pool.fetch(_LATEST_STATEMENTS[(payer_key, category is not None)], *params)
+        return [latest_expense_item(r) for r in rows]
+
+    @websocket_api.websocket_command(
+        {
+            vol.Required("type"): f"{DOMAIN}/list",
+            vol.Inclusive("before_date", "keyset"): cv.date,
+            vol.Inclusive("before_id", "keyset"): cv.positive_int,
+        }
+    )
+    @websocket_api.async_response
+    async def websocket_list_expenses(hass, connection, msg):
+        """Return the rows behind expenses_api.latest_expenses, or the page below a given keyset."""
+        if "before_id" not in msg:
+            expenses_list = latest["expenses"]
+        else:
+            filters = latest["filters"] or read_latest_filters()
+            expenses_list = await fetch_latest_page(filters, (msg["before_date"], msg["before_id"]))
+        connection.send_result(
+            msg["id"],
+            {"expenses": [e._asdict() for e in expenses_list], "next": page_cursor(expenses_list)},
+        )
+
+    websocket_api.async_register_command(hass, websocket_list_expenses)
+
+    async def async_update_latest_expenses():
+        latest["refresh_seq"] += 1
+        refresh_seq = latest["refresh_seq"]
         try:
-            paid_by = safe_state("input_select.filter_paid_by", "All")
-            category = safe_state("input_select.filter_category", "All")
-            start_date_str = safe_state("input_datetime.filter_start_date")
-            end_date_str = safe_state("input_datetime.filter_end_date")
-
-            start_date = None
-            end_date = None
-            if start_date_str:
-                start_date = datetime.datetime.fromisoformat(start_date_str.split(" ")[0]).date()
-            if end_date_str:
-                end_date = datetime.datetime.fromisoformat(end_date_str.split(" ")[0]).date()
-
-            query = "SELECT id, date, description, category, cost, andre, helena, paid_by FROM expenses WHERE 1=1"
-            params = []
-
-            # filter by payer using signed columns: positive value indicates who paid
-            if paid_by != "All":
-                query += " AND paid_by = %s"
-                params.append(paid_by.strip().lower())
-            if category != "All":
-                query += " AND category = %s"
-                params.append(category)
-            if start_date:
-                query += " AND date >= %s"
-                params.append(start_date)
-            if end_date:
-                query += " AND date <= %s"
-                params.append(end_date)
-
-            query += " ORDER BY date DESC, id DESC"
-
-            with conn.cursor() as cur:
-                cur.execute(query, tuple(params))
-                rows = cur.fetchall()
-
-            expenses_list = [
-                {
-                    "id": r[0],
-                    "date": r[1].isoformat() if r[1] else None,
-                    "description": r[2],
-                    "category": r[3],
-                    "cost": float(r[4]) if r[4] is not None else 0.0,
-                    "andre": float(r[5]) if len(r) > 5 and r[5] is not None else 0.0,
-                    "helena": float(r[6]) if len(r) > 6 and r[6] is not None else 0.0,
-                    "paid_by": r[7],
-                }
-                for r in rows
-            ]
-
-            # Sync-safe set state
-            hass.states.set(
-                "expenses_api.latest_expenses",
-                len(expenses_list),  # short state
-                attributes={
-                    "expenses": expenses_list
-                }
-            )
+            while True:
+                generation = latest["generation"]
+                filters = read_latest_filters()
+                expenses_list = await fetch_latest_page(filters)
+                # Queries run on separate pooled connections and can finish out of
+                # order; a newer refresh owns the list, so drop this result
+                if latest["refresh_seq"] != refresh_seq:
+                    return
+                # Re-query if an expense was added (and merged) while we were fetching
+                if latest["generation"] == generation:
+                    break
+
+            latest["filters"] = filters
+            latest["expenses"] = expenses_list
+            publish_latest_expenses(expenses_list)
 
         except Exception as e:
             _LOGGER.error("Failed to update latest expenses: %s", e)
 
+    @callback
+    def merge_into_latest_expenses(row):
+        """Insert a newly added expense row into the published list.
+
+        Returns False if no list has been published yet and a full refresh is needed.
+        """
+        if latest["filters"] is None:
+            return False
+
+        start_date, end_exclusive, paid_by, category = latest["filters"]
+        if row["date"] is None or not start_date <= row["date"] < end_exclusive:
+            return True
+        if paid_by is not None and row["paid_by"] != paid_by:
+            return True
+        if category is not None and row["category"] != category:
+            return True
+
+        item = latest_expense_item(row)
+        # Keep ORDER BY date DESC, id DESC; ISO dates compare correctly as strings
+        key = (item.date, item.id)
+        expenses_list = [e for e in latest["expenses"] if e.id != item.id]
+        index = next(
+            (i for i, e in enumerate(expenses_list) if (e.date, e.id) < key),
+            len(expenses_list),
+        )
+        if index >= _LATEST_PAGE_SIZE:
+            # Sorts below the first page
+            return True
+        expenses_list.insert(index, item)
+        del expenses_list[_LATEST_PAGE_SIZE:]
+
+        latest["expenses"] = expenses_list
+        publish_latest_expenses(expenses_list)
+        return True
+
+    # --- Expense detail (per-person split, fetched on demand) ---
+    async def async_update_expense_detail(expense_id):
+        try:
+            record = await pool.fetchrow(
+                f"SELECT {_LATEST_SELECT}, (andre * 100)::bigint AS andre_cents, (helena * 100)::bigint AS helena_cents"
+                " FROM expenses WHERE id = $1::bigint",
+                expense_id,
+            )
+
+            if record is None:
+                hass.states.async_set(f"{DOMAIN}.expense_detail", "not_found", attributes={"id": expense_id})
+                return
+
+            row = latest_expense_item(record)._asdict()
+            andre_cents = record["andre_cents"]
+            helena_cents = record["helena_cents"]
+            row["andre"] = andre_cents / 100 if andre_cents is not None else 0.0
+            row["helena"] = helena_cents / 100 if helena_cents is not None else 0.0
+            hass.states.async_set(f"{DOMAIN}.expense_detail", row["id"], attributes=row)
+
+        except Exception as e:
+            _LOGGER.error("Failed to fetch expense detail: %s", e)
+
     # --- Split helpers ---
+    # Bumped by the state listener whenever a split helper changes, so the
+    # parsed percentages are only recomputed when their inputs actually moved
+    split_cache = {"version": 0, "cached_version": None, "value": None}
+
     def get_split_percentages():
+        """Return the cached result of read_split_percentages(), recomputing it after a split change."""
+        version = split_cache["version"]
+        if split_cache["cached_version"] != version:
+            split_cache["value"] = read_split_percentages()
+            split_cache["cached_version"] = version
+        return split_cache["value"]
+
+    def read_split_percentages():
         """Return (andre_pct, helena_pct, total_pct).
 
         Priority:
         1. Read Home Assistant `input_number.split_andre` and `input_number.split_helena` (0-100)
         2. Fall back to hardcoded defaults (60/40)
 
-        Returned percentages are in 0..1 range.
+        Returned percentages are exact Fractions in 0..1 range, parsed straight
+        from the state strings so no binary float rounding leaks into shares.
         """
-        default_andre = 0.6
-        default_helena = 0.4
+        default_andre = Fraction(60, 100)
+        default_helena = Fraction(40, 100)
 
         # Try Home Assistant input_numbers (0-100)
-        andre_state = safe_state("input_number.split_andre", None)
-        helena_state = safe_state("input_number.split_helena", None)
+        states = snapshot_states(_SPLIT_ENTITIES)
+        andre_state = states["input_number.split_andre"]
+        helena_state = states["input_number.split_helena"]
 
         andre_pct = None
         helena_pct = None
 
         try:
             if andre_state is not None:
-                andre_pct = float(andre_state) / 100.0
+                andre_pct = Fraction(andre_state) / 100
         except (TypeError, ValueError):
             andre_pct = None
 
         try:
             if helena_state is not None:
-                helena_pct = float(helena_state) / 100.0
+                helena_pct = Fraction(helena_state) / 100
         except (TypeError, ValueError):
             helena_pct = None
 
@@ -162,30 +524,26 @@ def setup(hass, config):
             helena_pct = default_helena
 
         total_pct = andre_pct + helena_pct
-        eps = 1e-9
         if total_pct == 0:
             andre_pct, helena_pct = default_andre, default_helena
-        else:
-            if abs(total_pct - 1.0) > eps:
-                _LOGGER.warning("Split percentages do not sum to 1 — normalizing")
+        elif total_pct != 1:
+            _LOGGER.warning("Split percentages do not sum to 1, normalizing")
             andre_pct /= total_pct
             helena_pct /= total_pct
-            total_pct = 1.0
-            
-        return andre_pct, helena_pct, total_pct
+        total_pct = Fraction(1)
 
-    def compute_shares(cost, andre_pct, helena_pct, total_pct):
-        """Return (andre_share, helena_share) rounded to 2 decimals and adjusted for rounding drift."""
-        andre_share = (cost * Decimal(str(andre_pct / total_pct))).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        helena_share = (cost * Decimal(str(helena_pct / total_pct))).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        diff = cost - (andre_share + helena_share)
-        if diff != 0:
-            andre_share += diff
+        return andre_pct, helena_pct, total_pct
 
-        return andre_share, helena_share
+    def compute_shares(cost_cents, andre_pct, helena_pct, total_pct):
+        """Return (andre_share, helena_share) in integer cents; Andre's share absorbs the rounding drift."""
+        helena_ratio = helena_pct / total_pct
+        helena_share = _div_round_half_up(cost_cents * helena_ratio.numerator, helena_ratio.denominator)
+        return cost_cents - helena_share, helena_share
 
-    def reset_input_fields(category, date_str):
-            hass.services.call(
+    async def async_reset_input_fields(category, date_str):
+        """Clear the add-expense helpers, issuing all service calls in one event-loop hop."""
+        await asyncio.gather(
+            hass.services.async_call(
                 "input_text",
                 "set_value",
                 {
@@ -193,9 +551,8 @@ def setup(hass, config):
                     "value": ""
                 },
                 blocking=False
-            )
-
-            hass.services.call(
+            ),
+            hass.services.async_call(
                 "input_number",
                 "set_value",
                 {
@@ -203,8 +560,8 @@ def setup(hass, config):
                     "value": 0.0
                 },
                 blocking=False
-            )
-            hass.services.call(
+            ),
+            hass.services.async_call(
                 "input_select",
                 "select_option",
                 {
@@ -212,8 +569,8 @@ def setup(hass, config):
                     "option": category
                 },
                 blocking=False
-            )
-            hass.services.call(
+            ),
+            hass.services.async_call(
                 "input_datetime",
                 "set_datetime",
                 {
@@ -221,157 +578,220 @@ def setup(hass, config):
                     "datetime": date_str
                 },
                 blocking=False
+            ),
+        )
+
+    # Monotonic timestamp of the last error notification
+    last_notification = {"at": None}
+
+    @callback
+    def notify_error(message):
+        """Raise a persistent notification, at most once per _NOTIFY_MIN_INTERVAL_SECONDS."""
+        now = time.monotonic()
+        if last_notification["at"] is not None and now - last_notification["at"] < _NOTIFY_MIN_INTERVAL_SECONDS:
+            _LOGGER.debug("Suppressing error notification: %s", message)
+            return
+        last_notification["at"] = now
+
+        hass.async_create_task(
+            hass.services.async_call(
+                "persistent_notification",
+                "create",
+                {
+                    "title": "Expenses API Error",
+                    "message": message,
+                    "notification_id": "expenses_api_error"
+                },
             )
+        )
 
-    def handle_add_expense(call):
+    async def async_handle_add_expense(call):
         try:
-            date_str = safe_state("input_datetime.expense_date")
-            description = safe_state("input_text.expense_description", "")
-            category = safe_state("input_select.expense_category", "Other")
-            cost = Decimal(str(safe_state("input_number.expense_amount", 0))).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            paid_by = safe_state("input_select.expense_paid_by", "Unknown")
+            states = snapshot_states(_EXPENSE_FORM_ENTITIES)
+            date_str = states["input_datetime.expense_date"]
+            description = states["input_text.expense_description"] or ""
+            category = states["input_select.expense_category"] or "Other"
+            cost_cents = _to_cents(states["input_number.expense_amount"] or 0)
+            paid_by = states["input_select.expense_paid_by"] or "Unknown"
             # split: get percentages and compute shares
             andre_pct, helena_pct, total_pct = get_split_percentages()
-            andre_share, helena_share = compute_shares(cost, andre_pct, helena_pct, total_pct)
-            _LOGGER.debug("Computed shares: Andre=%s Helena=%s (cost=%s)", andre_share, helena_share, cost)
+            andre_share, helena_share = compute_shares(cost_cents, andre_pct, helena_pct, total_pct)
+            _LOGGER.debug("Computed shares (cents): Andre=%s Helena=%s (cost=%s)", andre_share, helena_share, cost_cents)
             
 
-            date_value = None
-            if date_str:
-                date_value = datetime.datetime.fromisoformat(date_str.split(" ")[0]).date()
+            if not date_str:
+                # Undated rows fall outside the list's date bounds and would never be shown
+                raise ValueError("No expense date selected")
+            date_value = _parse_date(date_str)
 
             paid_by_norm = (paid_by or "").strip().lower()
-            andre_val = None
-            helena_val = None
+            andre_cents = None
+            helena_cents = None
             if paid_by_norm == "andre":
                 # Helena owes Andre her share
-                helena_val = -helena_share
-                andre_val = +helena_share
+                helena_cents = -helena_share
+                andre_cents = +helena_share
             elif paid_by_norm == "helena":
                 # Andre owes Helena his share
-                andre_val = -andre_share
-                helena_val = +andre_share
+                andre_cents = -andre_share
+                helena_cents = +andre_share
             else:
                 raise ValueError(f"Invalid payer selected: {paid_by!r}")
-            
-            andre_val = Decimal(andre_val).quantize(Decimal("0.01"))
-            helena_val = Decimal(helena_val).quantize(Decimal("0.01"))
 
-            if andre_val + helena_val != Decimal("0.00"):
+            # Skipped entirely under `python -O`
+            if __debug__ and andre_cents != -helena_cents:
                 raise RuntimeError(
                     f"Ledger invariant violated: "
-                    f"andre={andre_val}, helena={helena_val}"
-    )
-
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO expenses 
-                    (description, cost, category, date, andre, helena, paid_by)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (description, cost, category, date_value, andre_val, helena_val, paid_by_norm)
+                    f"andre={andre_cents}, helena={helena_cents} (cents)"
                 )
 
-            _LOGGER.info("Expense added: %s %.2f by %s", description, cost, paid_by)
+            (row,) = await _insert_expenses(
+                pool,
+                [(description, cost_cents, category, date_value, andre_cents, helena_cents, paid_by_norm)],
+            )
+
+            latest["generation"] += 1
+
+            _LOGGER.info("Expense added: %s %.2f by %s", description, cost_cents / 100, paid_by)
 
-            update_balances()
-            update_latest_expenses()
-            reset_input_fields(category, date_str)
+            # Publish from the returned totals and row instead of re-querying
+            if row["andre_total_cents"] is None:
+                _LOGGER.warning("balances row missing, rebuilding it from expenses")
+                await async_update_balances(resync=True)
+            else:
+                publish_balances(row["andre_total_cents"], row["helena_total_cents"])
+            if not merge_into_latest_expenses(row):
+                await async_update_latest_expenses()
+            hass.async_create_task(async_reset_input_fields(category, date_str))
             
             
 
-        except Exception as e:
+        except ValueError as e:
+            _LOGGER.error("Invalid expense: %s", e)
+            notify_error(str(e))
+        except _DB_ERRORS as e:
             _LOGGER.error("Failed to add expense: %s", e)
-
-            hass.services.call(
-                "persistent_notification",
-                "create",
-                {
-                    "title": "Expenses API Error",
-                    "message": str(e),
-                    "notification_id": "expenses_api_error"
-                },
-            )
+            notify_error(str(e))
 
     # --- Initial fetch ---
-    update_latest_expenses()
+    await async_update_latest_expenses()
 
     # --- Listen for filter changes ---
+    # Pending debounced refresh; only touched from the event loop
+    refresh_timer = {"handle": None}
+
+    @callback
+    def run_debounced_refresh():
+        refresh_timer["handle"] = None
+        hass.async_create_task(async_update_latest_expenses())
+
+    @callback
     def state_change_listener(event):
         entity_id = event.data.get("entity_id")
-        if entity_id in [
-            "input_select.filter_paid_by",
-            "input_select.filter_category",
-            "input_datetime.filter_start_date",
-            "input_datetime.filter_end_date"
-        ]:
-            update_latest_expenses()
+        if entity_id in _FILTER_ENTITIES:
+            # Date pickers and rapid toggles emit several changes; query once they settle
+            if refresh_timer["handle"] is not None:
+                refresh_timer["handle"].cancel()
+            refresh_timer["handle"] = hass.loop.call_later(_REFRESH_DEBOUNCE_SECONDS, run_debounced_refresh)
+        elif entity_id in _SPLIT_ENTITIES:
+            split_cache["version"] += 1
 
-    hass.bus.listen(EVENT_STATE_CHANGED, state_change_listener)
+    # Only dispatched for our helpers instead of every state change in the system
+    async_track_state_change_event(hass, list(_FILTER_ENTITIES | _SPLIT_ENTITIES), state_change_listener)
 
 
     # --- Register services ---
-    hass.services.register(DOMAIN, "add_expense", handle_add_expense)
-    hass.services.register(DOMAIN, "refresh_latest_expenses", lambda call: update_latest_expenses())
+    async def async_handle_refresh_latest_expenses(call):
+        await async_update_latest_expenses()
+
+    async def async_handle_get_expense_detail(call):
+        await async_update_expense_detail(call.data["id"])
+
+    hass.services.async_register(DOMAIN, "add_expense", async_handle_add_expense)
+    hass.services.async_register(DOMAIN, "refresh_latest_expenses", async_handle_refresh_latest_expenses)
+    hass.services.async_register(
+        DOMAIN,
+        "get_expense_detail",
+        async_handle_get_expense_detail,
+        schema=vol.Schema({vol.Required("id"): cv.positive_int}),
+    )
 
     # --- Balances helper ---
-    def update_balances():
-        """Query DB sums for `andre` and `helena`, set HA input_number states and return totals."""
+    @callback
+    def publish_balances(andre_cents, helena_cents):
+        """Set the HA balance/settlement states from the given totals (integer cents)."""
+        andre_total = andre_cents / 100
+        helena_total = helena_cents / 100
+
+        net = round(andre_total, 2)
+
+        if net > 0:
+            summary = f"Helena owes Andre: €{abs(net):.2f}"
+        elif net < 0:
+            summary = f"Andre owes Helena: €{abs(net):.2f}"
+        else:
+            summary = "All settled up"
+
+        hass.states.async_set("input_number.balance_andre", round(andre_total,2))
+        hass.states.async_set("input_number.balance_nocas", round(helena_total,2))
+        hass.states.async_set(
+            f"{DOMAIN}.settlement",
+            summary,
+            attributes={
+                "andre_balance": andre_total,
+                "helena_balance": helena_total,
+                "net": net
+            },
+        )
+
+        # Also set an entity summarizing balances for quick checks
+        hass.states.async_set(
+            f"{DOMAIN}.balances",
+            "ok",
+            attributes={"andre": andre_total, "nocas": helena_total},
+        )
+
+        _LOGGER.debug("Balances updated: andre=%s nocas=%s", andre_total, helena_total)
+        return andre_total, helena_total
+
+    async def async_update_balances(resync=False):
+        """Read the `balances` row (or, with resync, rebuild it from DB sums), publish it and return totals."""
         try:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT 
-                        COALESCE(SUM(andre),0),
-                        COALESCE(SUM(helena),0)
-                    FROM expenses
-                """)
-                r = cur.fetchone()
-
-            andre_total = float(r[0] or 0.0)
-            helena_total = float(r[1] or 0.0)
-
-            net = round(andre_total, 2)
-
-            if net > 0:
-                summary = f"Helena owes Andre: €{abs(net):.2f}"
-            elif net < 0:
-                summary = f"Andre owes Helena: €{abs(net):.2f}"
+            if resync:
+                async with pool.acquire() as conn, conn.transaction():
+                    # Lock the row before summing: a concurrent add_expense then waits on its
+                    # balances UPDATE and applies its delta on top of the rebuilt totals,
+                    # and adds committed before the lock are in the SUM's (later) snapshot
+                    await conn.execute("SELECT 1 FROM balances WHERE id = 1 FOR UPDATE")
+                    r = await conn.fetchrow("""
+                        INSERT INTO balances (id, andre, helena)
+                        SELECT 
+                            1,
+                            COALESCE(SUM(andre),0),
+                            COALESCE(SUM(helena),0)
+                        FROM expenses
+                        ON CONFLICT (id) DO UPDATE
+                        SET andre = EXCLUDED.andre, helena = EXCLUDED.helena
+                        RETURNING (andre * 100)::bigint, (helena * 100)::bigint
+                    """)
             else:
-                summary = "All settled up"
-
-            # Sync-safe set state values
-            hass.states.set("input_number.balance_andre", round(andre_total,2))
-            hass.states.set("input_number.balance_nocas", round(helena_total,2))
-            hass.states.set(
-                f"{DOMAIN}.settlement",
-                summary,
-                attributes={
-                    "andre_balance": andre_total,
-                    "helena_balance": helena_total,
-                    "net": net
-                },
-)
+                r = await pool.fetchrow("SELECT (andre * 100)::bigint, (helena * 100)::bigint FROM balances WHERE id = 1")
 
-            # Also set an entity summarizing balances for quick checks
-            hass.states.set(
-                f"{DOMAIN}.balances",
-                "ok",
-                attributes={"andre": andre_total, "nocas": helena_total},
-            )
-
-            _LOGGER.debug("Balances updated: andre=%s nocas=%s", andre_total, helena_total)
-            return andre_total, helena_total
+            return publish_balances(r[0] or 0, r[1] or 0)
         except Exception as e:
             _LOGGER.error("Failed to update balances: %s", e)
             raise
 
-    hass.services.register(DOMAIN, "refresh_balances", lambda call: update_balances())
-    hass.states.set(f"{DOMAIN}.loaded", "true")
+    async def async_handle_refresh_balances(call):
+        await async_update_balances(resync=True)
+
+    hass.services.async_register(DOMAIN, "refresh_balances", async_handle_refresh_balances)
+    hass.states.async_set(f"{DOMAIN}.loaded", "true")
 
-    def on_ha_started(event):
-        update_balances()
+    async def on_ha_started(event):
+        # Resync so corrections made directly in SQL are picked up on restart
+        await async_update_balances(resync=True)
 
-    hass.bus.listen_once(EVENT_HOMEASSISTANT_STARTED, on_ha_started)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STARTED, on_ha_started)
 
     return True